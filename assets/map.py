@@ -1,12 +1,147 @@
 #!/usr/bin/python
+"""Cut the map into tiles and convert them into GPU-ready textures.
+
+Usage:
+
+    map.py map.png                      cut tiles and write their textures
+    map.py --textures tile-*.png        convert existing tiles
+    map.py --raw --textures tile-*.png  convert without compression
+
+Every tile gets a .tex file next to its PNG, which the game uploads
+without decoding the PNG.  Textures are DXT5 compressed with the GL
+driver when pyglet can open a window and the driver supports S3TC,
+about 1 MB per full tile (~190 MB for the whole map).  Otherwise, or
+with --raw, they hold raw RGBA, about 4 MB per full tile (~750 MB for
+the whole map).  The game compresses raw textures as it uploads them
+when it can, so convert with --raw for machines without S3TC.
+"""
 import sys
+import struct
+import ctypes
 from PIL import Image
 
 tile_size = (1024, 1024)
 
+# Keep in sync with salmon.py, and bump TEXTURE_VERSION on any change
+TEXTURE_MAGIC = b'TEX0'
+TEXTURE_VERSION = 2
+# magic, version, width, height, format
+TEXTURE_HEADER = struct.Struct('<4sHHHI')
+GL_RGBA = 0x1908
+GL_COMPRESSED_RGBA_S3TC_DXT5_EXT = 0x83F3
+
+
+def texture_name(filename):
+    return filename.rsplit('.', 1)[0] + '.tex'
+
+
+def padded(size):
+    """Round size up to a multiple of 4, the DXT block size."""
+    return (size + 3) // 4 * 4
+
+
+# Hidden window that provides the GL context for dxt5_compress, False
+# once we know we can't have one
+context_window = None
+
+
+def gl_context():
+    """Make a GL context current, return False if there can't be one."""
+    global context_window
+    if context_window is None:
+        try:
+            import pyglet
+            context_window = pyglet.window.Window(visible=False)
+        except Exception as e:
+            # No pyglet, no display or no usable GL config
+            sys.stderr.write('Cannot open a GL context (%s), '
+                             'writing raw textures\n' % e)
+            context_window = False
+    if context_window:
+        context_window.switch_to()
+    return bool(context_window)
+
+
+def dxt5_compress(data, width, height):
+    """Compress raw RGBA rows with the GL driver.
+
+    Returns None if the driver cannot do S3TC compression.
+    """
+    if not gl_context():
+        return None
+    from pyglet import gl
+    from pyglet.gl import gl_info
+
+    if not gl_info.have_extension('GL_EXT_texture_compression_s3tc'):
+        return None
+
+    texture_id = gl.GLuint()
+    gl.glGenTextures(1, ctypes.byref(texture_id))
+    try:
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture_id.value)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, GL_COMPRESSED_RGBA_S3TC_DXT5_EXT,
+                        width, height, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                        data)
+        compressed = gl.GLint()
+        gl.glGetTexLevelParameteriv(gl.GL_TEXTURE_2D, 0,
+                                    gl.GL_TEXTURE_COMPRESSED,
+                                    ctypes.byref(compressed))
+        internalformat = gl.GLint()
+        gl.glGetTexLevelParameteriv(gl.GL_TEXTURE_2D, 0,
+                                    gl.GL_TEXTURE_INTERNAL_FORMAT,
+                                    ctypes.byref(internalformat))
+        if (not compressed.value or
+            internalformat.value != GL_COMPRESSED_RGBA_S3TC_DXT5_EXT):
+            # The driver quietly kept it uncompressed
+            return None
+        size = gl.GLint()
+        gl.glGetTexLevelParameteriv(gl.GL_TEXTURE_2D, 0,
+                                    gl.GL_TEXTURE_COMPRESSED_IMAGE_SIZE,
+                                    ctypes.byref(size))
+        if size.value != width * height:
+            return None
+        buf = ctypes.create_string_buffer(size.value)
+        gl.glGetCompressedTexImage(gl.GL_TEXTURE_2D, 0, buf)
+        return buf.raw
+    finally:
+        gl.glDeleteTextures(1, ctypes.byref(texture_id))
+
+
+def save_texture(img, filename, compress=True):
+    """Save a tile as a texture ready for uploading, bottom row first.
+
+    The tile is padded to a multiple of 4 pixels on each side; the
+    header keeps its real size.
+    """
+    width, height = img.size
+    tile = Image.new('RGBA', (padded(width), padded(height)))
+    tile.paste(img.convert('RGBA'), (0, 0))
+    data = tile.transpose(Image.FLIP_TOP_BOTTOM).tobytes()
+    texture_format = GL_RGBA
+    if compress:
+        compressed = dxt5_compress(data, *tile.size)
+        if compressed is not None:
+            data = compressed
+            texture_format = GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+    with open(filename, 'wb') as f:
+        f.write(TEXTURE_HEADER.pack(TEXTURE_MAGIC, TEXTURE_VERSION,
+                                    width, height, texture_format))
+        f.write(data)
+
 
 def main():
-    img = Image.open(sys.argv[1])
+    args = sys.argv[1:]
+    compress = '--raw' not in args
+    if not compress:
+        args.remove('--raw')
+
+    if args[0] == '--textures':
+        for filename in args[1:]:
+            save_texture(Image.open(filename), texture_name(filename),
+                         compress)
+        return
+
+    img = Image.open(args[0])
     tile_w, tile_h = tile_size
     img_w, img_h = img.size
     for row, y in enumerate(range(0, img_h, tile_h)):
@@ -14,7 +149,9 @@ def main():
             filename = 'tile-%03d-%03d.png' % (row, col)
             w = min(tile_w, img_w - x)
             h = min(tile_h, img_h - y)
-            img.crop((x, y, x+w, y+h)).save(filename)
+            tile = img.crop((x, y, x+w, y+h))
+            tile.save(filename)
+            save_texture(tile, texture_name(filename), compress)
 
 
 if __name__ == '__main__':
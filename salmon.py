@@ -5,16 +5,26 @@ import random
 import math
 import logging
 import time
+import struct
+import ctypes
 from contextlib import contextmanager
 
 import pyglet
 from pyglet.window import key
 from pyglet import gl
+from pyglet.gl import gl_info
 
 
 DEBUG_VERSION = False
 TILE_SIZE = 1024
 
+# Tile textures written by assets/map.py --textures.  Keep in sync with
+# assets/map.py, which bumps TEXTURE_VERSION on any change.
+TEXTURE_MAGIC = b'TEX0'
+TEXTURE_VERSION = 2
+# magic, version, width, height, format
+TEXTURE_HEADER = struct.Struct('<4sHHHI')
+
 log = logging.getLogger('salmon')
 
 if DEBUG_VERSION:
@@ -37,9 +47,100 @@ def load_image(filename, **kw):
         setattr(img, k, v)
     return img
 
+class UnsupportedTexture(ValueError):
+    """The GL driver can't use this texture format."""
+
+
+def texture_name(filename):
+    return filename.rsplit('.', 1)[0] + '.tex'
+
+
+def padded(size):
+    """Round size up to a multiple of 4, the DXT block size."""
+    return (size + 3) // 4 * 4
+
+
+def load_texture(filename):
+    """Upload a texture converted by assets/map.py straight into GL.
+
+    Raw textures are compressed on upload where the driver supports
+    S3TC.  Raises UnsupportedTexture for DXT5 textures on drivers
+    without S3TC, ValueError if the file is damaged or stale, and
+    struct.error if the header is truncated.
+    """
+    have_s3tc = gl_info.have_extension('GL_EXT_texture_compression_s3tc')
+    f = pyglet.resource.file(filename, 'rb')
+    try:
+        magic, version, width, height, texture_format = (
+            TEXTURE_HEADER.unpack(f.read(TEXTURE_HEADER.size)))
+        if magic != TEXTURE_MAGIC:
+            raise ValueError('%s is not a texture file' % filename)
+        if version != TEXTURE_VERSION:
+            raise ValueError('%s is texture version %d, expected %d; convert '
+                             'the tiles again with assets/map.py'
+                             % (filename, version, TEXTURE_VERSION))
+        # Textures are stored padded to whole 4x4 blocks
+        padded_width, padded_height = padded(width), padded(height)
+        if texture_format == gl.GL_RGBA:
+            size = padded_width * padded_height * 4
+        elif texture_format == gl.GL_COMPRESSED_RGBA_S3TC_DXT5_EXT:
+            if not have_s3tc:
+                raise UnsupportedTexture(
+                    '%s needs S3TC texture compression' % filename)
+            size = padded_width * padded_height
+        else:
+            raise ValueError('%s has unknown texture format 0x%x'
+                             % (filename, texture_format))
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) != size:
+        raise ValueError('%s is truncated' % filename)
+
+    texture_id = gl.GLuint()
+    gl.glGenTextures(1, ctypes.byref(texture_id))
+    gl.glBindTexture(gl.GL_TEXTURE_2D, texture_id.value)
+    gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
+                       gl.GL_LINEAR)
+    gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
+                       gl.GL_LINEAR)
+    if texture_format == gl.GL_RGBA:
+        internalformat = gl.GL_RGBA
+        if have_s3tc:
+            internalformat = gl.GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, internalformat,
+                        padded_width, padded_height, 0,
+                        gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, data)
+    else:
+        gl.glCompressedTexImage2D(gl.GL_TEXTURE_2D, 0, texture_format,
+                                  padded_width, padded_height, 0,
+                                  len(data), data)
+    texture = pyglet.image.Texture(padded_width, padded_height,
+                                   gl.GL_TEXTURE_2D, texture_id.value)
+    # Padding is at the bottom, rows are stored bottom row first
+    return texture.get_region(0, padded_height - height, width, height)
+
 def get_mem_usage():
     return int(open('/proc/self/stat').read().split()[22])
 
+def smoothing(rate, dt):
+    """Fraction of the remaining distance to cover in dt seconds.
+
+    Exponential smoothing that gives the same result no matter how the
+    elapsed time is split into ticks.
+    """
+    return 1 - math.exp(-rate * dt)
+
+
+def lerp(a, b, t):
+    return a + (b - a) * t
+
+
+def angle_delta(a, b):
+    """Shortest signed rotation (in degrees) from a to b."""
+    return (b - a + 180) % 360 - 180
+
+
 @contextmanager
 def gl_matrix():
     gl.glPushMatrix()
@@ -61,11 +162,15 @@ def gl_state(bits=gl.GL_ALL_ATTRIB_BITS):
 
 class Camera(object):
 
+    # Covers 10% of the remaining distance per tick at 60 Hz
+    smoothing_rate = -math.log(0.9) * 60
+
     def __init__(self, game):
         self.game = game
         self.x = self.game.map_x
         self.y = self.game.map_y
         self.zoom = self.game.zoom
+        self.last_x, self.last_y, self.last_zoom = self.x, self.y, self.zoom
         self.target_x = self.x
         self.target_y = self.y
         self.target_zoom = self.zoom
@@ -121,12 +226,20 @@ class Camera(object):
             self.focus_timer = 1 # seconds
 
     def update(self, dt):
+        self.last_x, self.last_y, self.last_zoom = self.x, self.y, self.zoom
         self.target_x = self.game.map_x
         self.target_y = self.game.map_y
         self.target_zoom = self.game.zoom
-        self.x = int(self.x - (self.x - self.target_x) * 0.1)
-        self.y = int(self.y - (self.y - self.target_y) * 0.1)
-        self.zoom = self.zoom - (self.zoom - self.target_zoom) * 0.1
+        k = smoothing(self.smoothing_rate, dt)
+        self.x = lerp(self.x, self.target_x, k)
+        self.y = lerp(self.y, self.target_y, k)
+        self.zoom = lerp(self.zoom, self.target_zoom, k)
+
+    def interpolate(self, alpha):
+        """Camera position and zoom between the last two ticks."""
+        return (lerp(self.last_x, self.x, alpha),
+                lerp(self.last_y, self.y, alpha),
+                lerp(self.last_zoom, self.zoom, alpha))
 
 
 class River(object):
@@ -161,6 +274,9 @@ class River(object):
 
 class Salmon(object):
 
+    turn_rate = 20.0
+    rotation = 0
+
     def __init__(self, game):
         image = load_image("lasisa.png")
         image.anchor_x = image.width / 2
@@ -171,16 +287,25 @@ class Salmon(object):
         self.x = self.game.map_x
         self.y = self.game.map_y
         self.last_x, self.last_y = self.x, self.y
+        self.last_rotation = self.rotation
 
     def update(self, dt):
-        if (self.x, self.y) != (self.game.map_x, self.game.map_y):
-            self.last_x, self.last_y = (self.x, self.y)
-            self.x, self.y = self.game.map_x, self.game.map_y
-
-    def draw(self):
-        self.sprite.x = self.game.map_x
-        self.sprite.y = -self.game.map_y
-        self.sprite.rotation = math.degrees(math.atan2(self.game.map_y - self.game.next_y, self.game.map_x - self.game.next_x)) - 90
+        self.last_x, self.last_y = self.x, self.y
+        self.last_rotation = self.rotation
+        self.x, self.y = self.game.map_x, self.game.map_y
+        dx = self.x - self.game.next_x
+        dy = self.y - self.game.next_y
+        if dx or dy:
+            heading = math.degrees(math.atan2(dy, dx)) - 90
+            turn = angle_delta(self.rotation, heading)
+            turn *= smoothing(self.turn_rate, dt)
+            self.rotation = (self.rotation + turn) % 360
+
+    def draw(self, alpha=1.0):
+        self.sprite.x = lerp(self.last_x, self.x, alpha)
+        self.sprite.y = -lerp(self.last_y, self.y, alpha)
+        turn = angle_delta(self.last_rotation, self.rotation)
+        self.sprite.rotation = self.last_rotation + turn * alpha
         self.sprite.draw()
 
 
@@ -199,6 +324,8 @@ class Game(object):
     STARTED = object()
     zoom = 0.5
     update_freq = 1 / 60.
+    max_steps = 5 # per tick, catching up after a stall is capped
+    warned_unsupported_texture = False
     skip_loading = True
     current_choices = []
     choice_distance = 0
@@ -209,7 +336,8 @@ class Game(object):
         self.map_x, self.map_y = 1024 * 8, 1024 * 4
         self.salmon = Salmon(self)
         self.camera = Camera(self)
-        pyglet.clock.schedule_interval(self.camera.update, self.update_freq)
+        self.last_tick_time = time.time()
+        self.tick_accumulator = 0.0
         pyglet.clock.schedule_interval(self.update, self.update_freq)
 
         self.tiles = {}
@@ -414,8 +542,27 @@ class Game(object):
 
     last_move_time = None
     def update(self, dt):
+        # Simulate in fixed steps of update_freq, however late this tick is
+        self.tick_accumulator = min(self.tick_accumulator + dt,
+                                    self.update_freq * self.max_steps)
+        while self.tick_accumulator >= self.update_freq:
+            self.tick_accumulator -= self.update_freq
+            self.step(self.update_freq)
+        self.last_tick_time = time.time()
+
+    def step(self, dt):
         self.update_flashes(dt)
+        self.update_world(dt)
         self.salmon.update(dt)
+        self.camera.update(dt)
+
+    @property
+    def tick_alpha(self):
+        """How far rendering is between the last step and the next one."""
+        elapsed = self.tick_accumulator + time.time() - self.last_tick_time
+        return min(1.0, elapsed / self.update_freq)
+
+    def update_world(self, dt):
         if (self.state == self.LOADING or
             self.skip_loading):
             if self.missing_tiles:
@@ -520,14 +667,15 @@ class Game(object):
 
     speed = 100.0
     next_pos = None
+    next_x, next_y = 0, 0
 
     @property
     def tile_x(self):
-        return self.camera.x / 1024
+        return int(self.camera.x // TILE_SIZE)
 
     @property
     def tile_y(self):
-        return self.camera.y / 1024
+        return int(self.camera.y // TILE_SIZE)
 
     @property
     def drawable_tiles(self):
@@ -558,15 +706,17 @@ class Game(object):
         self.last_direction = "DOWN"
 
     def draw(self):
+        alpha = self.tick_alpha
+        camera_x, camera_y, zoom = self.camera.interpolate(alpha)
         gl.glTranslatef(window.width / 2, window.height // 2, 0)
-        gl.glScalef(self.camera.zoom, self.camera.zoom, 1.0)
-        gl.glTranslatef(-self.camera.x, self.camera.y, 0)
+        gl.glScalef(zoom, zoom, 1.0)
+        gl.glTranslatef(-camera_x, camera_y, 0)
         OPACITY = 255 # 255 actually, but I'm testing now
         for tile in self.drawable_tiles:
             if tile.opacity < OPACITY:
                 tile.opacity = min(OPACITY, int((time.time() - tile.loaded) * OPACITY))
             tile.draw()
-        self.salmon.draw()
+        self.salmon.draw(alpha)
         self.draw_arrows()
 
         for dot in self.dots:
@@ -575,8 +725,24 @@ class Game(object):
     def draw_ui(self):
         self.draw_flashes()
 
+    def load_tile_image(self, filename):
+        try:
+            return load_texture(texture_name(filename))
+        except pyglet.resource.ResourceNotFoundException:
+            return load_image(filename)
+        except UnsupportedTexture as e:
+            if not self.warned_unsupported_texture:
+                log.warning("%s, decoding PNGs instead; convert the tiles "
+                            "with assets/map.py --raw for this machine", e)
+                self.warned_unsupported_texture = True
+            return load_image(filename)
+        except (ValueError, struct.error) as e:
+            log.warning("Can't load texture for %s (%s), decoding PNG",
+                        filename, e)
+            return load_image(filename)
+
     def load_tile_sprite(self, filename):
-        image = load_image(filename)
+        image = self.load_tile_image(filename)
         image.anchor_x = TILE_SIZE / 2
         image.anchor_y = image.height - TILE_SIZE / 2
         return pyglet.sprite.Sprite(image)
@@ -594,6 +760,10 @@ class Game(object):
 class Main(pyglet.window.Window):
 
     fps_display = None
+    # Every scheduled call redraws the window, Game.update included, so
+    # this can only make rendering faster than Game.update_freq.  None
+    # redraws as often as the display allows.
+    render_freq = None
 
     def __init__(self):
         super(Main, self).__init__(width=1024, height=600,
@@ -606,11 +776,20 @@ class Main(pyglet.window.Window):
         #         os.path.join(pyglet.resource.location('Dodo.png').path, 'Dodo.png')))
         self.background_batch = pyglet.graphics.Batch()
         self.game = Game()
+        if self.render_freq:
+            pyglet.clock.schedule_interval(self.request_redraw,
+                                           self.render_freq)
+        else:
+            pyglet.clock.schedule(self.request_redraw)
 
         self.fps_display = pyglet.clock.ClockDisplay()
         self.fps_display.label.y = self.height - 50
         self.fps_display.label.x = self.width - 170
 
+    def request_redraw(self, dt):
+        # The event loop redraws windows whenever a scheduled function runs
+        pass
+
     def on_draw(self):
         self.clear()
         with gl_matrix():